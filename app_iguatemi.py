@@ -8,23 +8,54 @@ load_dotenv()
 
 import streamlit as st
 import chromadb
-import json
+import faiss
+import functools
+import hashlib
+import ijson
+import numpy as np
+import orjson
 import os
-from openai import OpenAI
-from chromadb.utils import embedding_functions
+import pandas as pd
+import re
+import sqlite3
+from openai import OpenAI, RateLimitError
 import glob
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from typing import Dict, List, Any
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from diskcache import Cache
 
     
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 # OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
 
-# Initialize OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+@st.cache_resource
+def get_openai_client() -> OpenAI:
+    """Share one OpenAI client (and its connection pool) across reruns."""
+    return OpenAI(api_key=OPENAI_API_KEY)
 
-SYSTEM_PROMPT = f"""Você é um assistente especializado em contratos do Shopping Center Iguatemi. 
+@st.cache_resource
+def get_chroma_client():
+    """Share one Chroma client so the sqlite backend is opened only once."""
+    return chromadb.PersistentClient(path="./chroma_db")
+
+client = get_openai_client()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 128
+UPSERT_BATCH_SIZE = 500
+GLOBAL_CONTEXT_CHAR_BUDGET = 12000
+EMBEDDINGS_CACHE_PATH = "embeddings_cache.db"
+METADATA_PARQUET_PATH = "./chroma_db/metadata.parquet"
+MTIMES_PATH = "./chroma_db/.mtimes.json"
+QUERY_CACHE_PATH = "query_cache"
+
+# On-disk query-embedding cache; survives Streamlit reruns and restarts
+query_cache = Cache(QUERY_CACHE_PATH)
+
+SYSTEM_PROMPT = """Você é um assistente especializado em contratos do Shopping Center Iguatemi. 
 
 Você lida com dois tipos de consultas:
 
@@ -41,129 +72,401 @@ Sempre:
 Dê respostas diretas e baseadas nos documentos e metadados fornecidos.
 Se houver falta de informação ou algo estiver incerto, mencione isso explicitamente.
 Formate números e datas de maneira consistente.
-Mantenha as respostas curtas e objetivas.
+Mantenha as respostas curtas e objetivas."""
 
-Hoje é {datetime.now().strftime("%d de %B de %Y")}"""
+@functools.lru_cache(maxsize=2)
+def current_date_message(today: date) -> str:
+    """Format today's date once per day for the conversation preamble."""
+    return f"Hoje é {today.strftime('%d de %B de %Y')}."
 
 def extract_metadata(content: Dict[str, Any]) -> Dict[str, Any]:
-    """Extract key metadata from contract JSON."""
-    loja = content.get('loja', {})
-    contrato = content.get('contratos', [{}])[0] if content.get('contratos') else {}
-    
+    """Extract key metadata from contract JSON.
+
+    Each nested dict is resolved once into a local before the fields are
+    read, instead of re-walking objeto/vigencia per field.
+    """
+    loja = content.get('loja') or {}
+    contratos = content.get('contratos')
+    contrato = contratos[0] if contratos else {}
+    objeto = contrato.get('objeto') or {}
+    vigencia = contrato.get('vigencia') or {}
+
     return {
         "store_name": loja.get('nome_fantasia', ''),
         "cnpj": loja.get('cnpj', ''),
         "contract_number": contrato.get('numero_contrato', ''),
-        "store_area": contrato.get('objeto', {}).get('area_privativa', ''),
-        "contract_start": contrato.get('vigencia', {}).get('data_inicial', ''),
-        "contract_end": contrato.get('vigencia', {}).get('data_final', ''),
-        "floor": contrato.get('objeto', {}).get('piso', ''),
-        "store_number": contrato.get('objeto', {}).get('loja', '')
+        "store_area": objeto.get('area_privativa', ''),
+        "contract_start": vigencia.get('data_inicial', ''),
+        "contract_end": vigencia.get('data_final', ''),
+        "floor": objeto.get('piso', ''),
+        "store_number": objeto.get('loja', '')
     }
 
+@retry(retry=retry_if_exception_type(RateLimitError),
+       wait=wait_exponential(multiplier=1, max=30),
+       stop=stop_after_attempt(5))
+def embed_batch(texts: List[str]) -> List[List[float]]:
+    """Embed a batch of texts in a single OpenAI API call."""
+    response = client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+    return [item.embedding for item in response.data]
+
+def embed_documents(documents: List[str]) -> List[List[float]]:
+    """Embed documents in batches instead of one API call per document."""
+    embeddings = []
+    for start in range(0, len(documents), EMBEDDING_BATCH_SIZE):
+        embeddings.extend(embed_batch(documents[start:start + EMBEDDING_BATCH_SIZE]))
+    return embeddings
+
+# ijson prefixes for the fields extract_metadata needs; "contratos.item"
+# prefixes match every contract, but only the first occurrence is kept
+METADATA_PREFIXES = {
+    'loja.nome_fantasia': 'store_name',
+    'loja.cnpj': 'cnpj',
+    'contratos.item.numero_contrato': 'contract_number',
+    'contratos.item.objeto.area_privativa': 'store_area',
+    'contratos.item.vigencia.data_inicial': 'contract_start',
+    'contratos.item.vigencia.data_final': 'contract_end',
+    'contratos.item.objeto.piso': 'floor',
+    'contratos.item.objeto.loja': 'store_number'
+}
+
+def current_contract_mtimes(directory_path: str) -> Dict[str, int]:
+    """Snapshot the contract files' mtimes for change detection."""
+    return {
+        path: os.stat(path).st_mtime_ns
+        for path in glob.glob(os.path.join(directory_path, "*.json"))
+    }
+
+def load_metadata_only(file_path: str) -> Dict[str, Any]:
+    """Stream-parse a contract JSON and pull out only the metadata fields.
+
+    Avoids materializing the full document tree when the text is not
+    needed for embedding (e.g. metadata refresh on an existing collection).
+    """
+    metadata = {key: '' for key in METADATA_PREFIXES.values()}
+    remaining = set(METADATA_PREFIXES)
+    with open(file_path, 'rb', buffering=1 << 20) as file:
+        for prefix, event, value in ijson.parse(file):
+            if prefix in remaining:
+                metadata[METADATA_PREFIXES[prefix]] = value
+                remaining.discard(prefix)
+                if not remaining:
+                    break
+    return metadata
+
+def refresh_metadata(directory_path: str) -> List[Dict[str, Any]]:
+    """Rebuild the metadata list without re-reading full documents."""
+    json_files = glob.glob(os.path.join(directory_path, "*.json"))
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return list(executor.map(load_metadata_only, json_files))
+
+def save_metadata_sidecar(all_metadata: List[Dict[str, Any]]) -> None:
+    """Persist the metadata list beside the Chroma store for fast cold starts."""
+    os.makedirs(os.path.dirname(METADATA_PARQUET_PATH), exist_ok=True)
+    pd.DataFrame(all_metadata).to_parquet(METADATA_PARQUET_PATH)
+
+def load_metadata_sidecar(directory_path: str) -> List[Dict[str, Any]]:
+    """Load the metadata list from its Parquet sidecar if still fresh.
+
+    Returns None when the sidecar is missing or any contract JSON is
+    newer, in which case the caller falls back to re-reading the files.
+    """
+    try:
+        sidecar_mtime = os.stat(METADATA_PARQUET_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    json_files = glob.glob(os.path.join(directory_path, "*.json"))
+    if not json_files or any(os.stat(path).st_mtime_ns > sidecar_mtime for path in json_files):
+        return None
+    return pd.read_parquet(METADATA_PARQUET_PATH).to_dict('records')
+
+def load_contract_file(file_path: str) -> tuple:
+    """Read and parse a single contract JSON, returning its id, content hash,
+    metadata and serialized text."""
+    # 1 MiB buffer: most contracts arrive in a single read syscall
+    with open(file_path, 'rb', buffering=1 << 20) as file:
+        raw = file.read()
+    content = orjson.loads(raw)
+    doc_id = os.path.splitext(os.path.basename(file_path))[0]
+    file_hash = hashlib.blake2b(raw).hexdigest()
+    return doc_id, file_hash, extract_metadata(content), orjson.dumps(content).decode('utf-8')
+
+def open_embeddings_cache() -> sqlite3.Connection:
+    """Open (creating if needed) the persistent embeddings cache."""
+    cache = sqlite3.connect(EMBEDDINGS_CACHE_PATH)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings_cache ("
+        "file_hash TEXT PRIMARY KEY, embedding BLOB, scale REAL)"
+    )
+    return cache
+
+def quantize_embedding(vector: List[float]) -> tuple:
+    """Scalar-quantize an embedding to int8 plus a per-vector scale.
+
+    Cuts stored vector size 4x versus float32; reconstruction error is
+    negligible for cosine retrieval at this corpus size.
+    """
+    values = np.asarray(vector, dtype=np.float32)
+    scale = (float(np.abs(values).max()) / 127.0) or 1.0
+    quantized = np.round(values / scale).astype(np.int8)
+    return quantized.tobytes(), scale
+
+def dequantize_embedding(blob: bytes, scale: float) -> List[float]:
+    """Reconstruct a float vector from its int8 representation."""
+    return (np.frombuffer(blob, dtype=np.int8).astype(np.float32) * scale).tolist()
+
+def get_embeddings(documents: List[str], hashes: List[str]) -> List[List[float]]:
+    """Resolve document embeddings through the on-disk cache.
+
+    Unchanged files (same content hash) reuse their stored vector; only
+    new or modified documents hit the embeddings API.
+    """
+    cache = open_embeddings_cache()
+    try:
+        embeddings = [None] * len(documents)
+        missing = []
+        for i, file_hash in enumerate(hashes):
+            row = cache.execute(
+                "SELECT embedding, scale FROM embeddings_cache WHERE file_hash = ?",
+                (file_hash,)
+            ).fetchone()
+            if row:
+                embeddings[i] = dequantize_embedding(row[0], row[1])
+            else:
+                missing.append(i)
+
+        if missing:
+            fresh = embed_documents([documents[i] for i in missing])
+            for i, vector in zip(missing, fresh):
+                embeddings[i] = vector
+                blob, scale = quantize_embedding(vector)
+                cache.execute(
+                    "INSERT OR REPLACE INTO embeddings_cache VALUES (?, ?, ?)",
+                    (hashes[i], blob, scale)
+                )
+            cache.commit()
+        return embeddings
+    finally:
+        cache.close()
+
+@functools.lru_cache(maxsize=1024)
+def _embed_query(normalized_query: str) -> tuple:
+    cached = query_cache.get(normalized_query)
+    if cached is None:
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=[normalized_query])
+        cached = tuple(response.data[0].embedding)
+        query_cache.set(normalized_query, cached)
+    return cached
+
+def embed_query(query: str) -> List[float]:
+    """Embed a user query once; repeats skip the embeddings round-trip."""
+    return list(_embed_query(query.strip().lower()))
+
+def read_mtimes() -> Dict[str, int]:
+    """Read the sidecar of file mtimes recorded at the last successful load."""
+    try:
+        with open(MTIMES_PATH, 'rb') as file:
+            return orjson.loads(file.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+def write_mtimes(mtimes: Dict[str, int]) -> None:
+    """Persist the current file mtimes for the next startup."""
+    os.makedirs(os.path.dirname(MTIMES_PATH), exist_ok=True)
+    with open(MTIMES_PATH, 'wb') as file:
+        file.write(orjson.dumps(mtimes))
+
+def build_search_index(embeddings: List[List[float]], documents: List[str],
+                       metadatas: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build an in-memory FAISS HNSW index over the document embeddings.
+
+    Queries hit this index directly; Chroma stays as the persistence
+    layer. Embeddings are unit-normalized, so L2 ranking matches cosine.
+    """
+    index = faiss.IndexHNSWFlat(len(embeddings[0]), 32)
+    index.add(np.asarray(embeddings, dtype=np.float32))
+    return {"index": index, "documents": documents, "metadatas": metadatas}
+
 def load_documents(directory_path: str):
     """Load documents with enhanced metadata handling."""
     try:
-        # Initialize embedding function and collection
-        embedding_function = embedding_functions.OpenAIEmbeddingFunction(
-            model_name="text-embedding-3-small",
-            api_key=OPENAI_API_KEY
-        )
+        chroma_client = get_chroma_client()
+        collection = chroma_client.get_or_create_collection(name="contracts")
         
-        chroma_client = chromadb.PersistentClient()
-        collection = chroma_client.get_or_create_collection(
-            name="contracts",
-            embedding_function=embedding_function
-        )
-        
-        # Clear existing documents by deleting using their IDs
-        current_docs = collection.get()
-        if current_docs.get('ids'):
-            collection.delete(ids=current_docs['ids'])
-        
-        # Process each JSON file
+        # Process JSON files concurrently; reading is I/O bound
         json_files = glob.glob(os.path.join(directory_path, "*.json"))
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            loaded = list(executor.map(load_contract_file, json_files))
+
         documents = []
         metadatas = []
         ids = []
+        hashes = []
         all_metadata = []  # Store complete metadata for session state
-        
-        for i, file_path in enumerate(json_files):
-            with open(file_path, 'r', encoding='utf-8') as file:
-                content = json.load(file)
-                
-                # Extract metadata
-                metadata = extract_metadata(content)
-                all_metadata.append(metadata)
-                
-                # Store the entire JSON as a string
-                documents.append(json.dumps(content, ensure_ascii=False))
-                metadatas.append(metadata)
-                ids.append(f"doc_{i}")
-        
+
+        for doc_id, file_hash, metadata, document in loaded:
+            all_metadata.append(metadata)
+            documents.append(document)
+            metadatas.append(metadata)
+            ids.append(doc_id)
+            hashes.append(file_hash)
+
+        # Drop only documents whose source files no longer exist;
+        # include=[] keeps Chroma from returning documents and metadatas
+        existing_ids = set(collection.get(include=[]).get('ids') or [])
+        stale_ids = existing_ids - set(ids)
+        if stale_ids:
+            collection.delete(ids=list(stale_ids))
+
         # Add documents to collection if there are any
+        search_index = None
         if documents:
-            collection.add(
-                documents=documents,
-                metadatas=metadatas,
-                ids=ids
-            )
+            embeddings = get_embeddings(documents, hashes)
+
+            # Upsert only files that are new or changed since the last load
+            previous_mtimes = read_mtimes()
+            current_mtimes = {path: os.stat(path).st_mtime_ns for path in json_files}
+            changed = [
+                i for i, (path, doc_id) in enumerate(zip(json_files, ids))
+                if doc_id not in existing_ids
+                or current_mtimes[path] != previous_mtimes.get(path)
+            ]
+            # Bounded batches keep Chroma's sqlite transactions small and
+            # let a partial failure resume from the last committed batch
+            for start in range(0, len(changed), UPSERT_BATCH_SIZE):
+                batch = changed[start:start + UPSERT_BATCH_SIZE]
+                collection.upsert(
+                    documents=[documents[i] for i in batch],
+                    metadatas=[metadatas[i] for i in batch],
+                    ids=[ids[i] for i in batch],
+                    embeddings=[embeddings[i] for i in batch]
+                )
+            write_mtimes(current_mtimes)
+
+            search_index = build_search_index(embeddings, documents, metadatas)
+
+        save_metadata_sidecar(all_metadata)
         
-        return collection, all_metadata
+        return collection, all_metadata, search_index
     except Exception as e:
         st.error(f"Error loading documents: {str(e)}")
-        return None, None
+        return None, None, None
 
-def handle_global_query(query: str, metadata_list: List[Dict[str, Any]], collection) -> tuple:
-    """Handle global queries using metadata and selective retrieval."""
-    # Pre-process metadata based on query type
-    if "venc" in query.lower():  # Contract expiration related
-        relevant_data = {
-            "contracts": [
-                {
-                    "store": m["store_name"],
-                    "end_date": m["contract_end"]
-                } for m in metadata_list if m["contract_end"]
-            ]
-        }
-    elif "área" in query.lower() or "area" in query.lower():  # Area related
-        relevant_data = {
-            "stores": [
-                {
-                    "store": m["store_name"],
-                    "area": m["store_area"]
-                } for m in metadata_list if m["store_area"]
-            ]
-        }
+# Intent keywords are whole words, so hash lookups on the token set beat
+# substring (or regex alternation) scans; "venc" is a stem matching
+# vencimento/vencem/vence
+GLOBAL_TOKENS = frozenset({
+    'todos', 'todas', 'quantos', 'quantas', 'total',
+    'geral', 'shopping', 'contratos'
+})
+AREA_TOKENS = frozenset({'área', 'area', 'áreas', 'areas'})
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def detect_intents(query: str) -> set:
+    """Classify the query with one tokenization pass and set lookups."""
+    tokens = set(_TOKEN_RE.findall(query.lower()))
+    intents = set()
+    if not GLOBAL_TOKENS.isdisjoint(tokens):
+        intents.add("global_")
+    if any(token.startswith("venc") for token in tokens):
+        intents.add("expiration")
+    if not AREA_TOKENS.isdisjoint(tokens):
+        intents.add("area")
+    return intents
+
+def build_aggregates(metadata_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Precompute the aggregate views served by handle_global_query.
+
+    Built once per collection load; the metadata goes through a
+    column-wise DataFrame so filtering and sorting run as vectorized
+    pandas kernels instead of per-row Python comprehensions.
+    """
+    if not metadata_list:
+        return {"contracts_by_end_date": [], "stores_by_area": [],
+                "total_stores": 0, "floors": {}}
+
+    frame = pd.DataFrame(metadata_list)
+
+    # Dates are mostly dd/mm/yyyy, some dotted (31.05.2028), some textual
+    # ("Indeterminado"). Normalize separators, sort the parseable dates
+    # chronologically and append the rest, so every contract with a
+    # non-empty end value stays in the list sent to the model
+    with_end = frame.loc[frame['contract_end'].astype(bool), ['store_name', 'contract_end']]
+    end_dates = pd.to_datetime(
+        with_end['contract_end'].str.replace('.', '/', regex=False),
+        format='%d/%m/%Y', errors='coerce'
+    )
+    parseable = end_dates.notna()
+    contracts = pd.concat([
+        with_end[parseable]
+        .assign(_end=end_dates[parseable])
+        .sort_values('_end')
+        .drop(columns='_end'),
+        with_end[~parseable]
+    ]).rename(columns={'store_name': 'store', 'contract_end': 'end_date'})
+
+    has_area = frame['store_area'].astype(bool)
+    stores = (
+        frame.loc[has_area, ['store_name', 'store_area']]
+        .rename(columns={'store_name': 'store', 'store_area': 'area'})
+    )
+
+    return {
+        "contracts_by_end_date": contracts.to_dict('records'),
+        "stores_by_area": stores.to_dict('records'),
+        "total_stores": len(frame),
+        "floors": frame.loc[frame['floor'].astype(bool), 'floor'].value_counts().to_dict()
+    }
+
+def handle_global_query(query: str, intents: set, aggregates: Dict[str, Any], collection) -> tuple:
+    """Handle global queries using precomputed aggregates and selective retrieval."""
+    if "expiration" in intents:  # Contract expiration related
+        relevant_data = {"contracts": aggregates["contracts_by_end_date"]}
+    elif "area" in intents:  # Area related
+        relevant_data = {"stores": aggregates["stores_by_area"]}
     else:  # For other global queries, get most relevant documents but limit context
         results = collection.query(
-            query_texts=[query],
-            n_results=100  # Limit to most relevant documents for general queries
+            query_embeddings=[embed_query(query)],
+            n_results=10,  # Top matches only; 100 full documents overflow the model context
+            include=["documents", "metadatas"]
         )
         return results, None
     
     return None, relevant_data
 
-def handle_store_query(query: str, collection) -> tuple:
-    """Handle store-specific queries."""
-    results = collection.query(
-        query_texts=[query],
-        n_results=1
-    )
+def handle_store_query(query: str, search_index: Dict[str, Any]) -> tuple:
+    """Handle store-specific queries via the in-memory FAISS index."""
+    query_vector = np.asarray([embed_query(query)], dtype=np.float32)
+    _, indices = search_index["index"].search(query_vector, 1)
+    hit = int(indices[0, 0])
+    if hit < 0:
+        return None, None
+    results = {
+        "documents": [[search_index["documents"][hit]]],
+        "metadatas": [[search_index["metadatas"][hit]]]
+    }
     return results, None
 
-def get_chat_response(query: str, context: str, metadata_summary: Dict = None) -> str:
-    """Get response from GPT-4o based on query type and available information."""
+def get_chat_response(query: str, context: str, metadata_summary: Dict = None):
+    """Stream the GPT-4o response based on query type and available information.
+
+    Returns a generator of text chunks for st.write_stream, so tokens
+    render as they arrive instead of after the full completion.
+    """
     try:
+        # The date lives in its own short user turn so the (long) system
+        # prompt stays byte-identical and benefits from server-side
+        # prompt caching
         messages = [
             {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": current_date_message(date.today())},
         ]
         
         # Add metadata summary if available
         if metadata_summary:
             messages.append({
                 "role": "user",
-                "content": f"Metadata summary: {json.dumps(metadata_summary, ensure_ascii=False)}\n\nQuestion: {query}"
+                "content": f"Metadata summary: {orjson.dumps(metadata_summary).decode('utf-8')}\n\nQuestion: {query}"
             })
         else:
             messages.append({
@@ -171,14 +474,25 @@ def get_chat_response(query: str, context: str, metadata_summary: Dict = None) -
                 "content": f"Context: {context}\n\nQuestion: {query}"
             })
         
-        response = client.chat.completions.create(
+        stream = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=messages,
             temperature=0,
-            max_tokens=500
+            max_tokens=500,
+            stream=True
         )
-        
-        return response.choices[0].message.content
+
+        # Errors can also surface while the stream is consumed (inside
+        # st.write_stream), so the iteration gets its own handler
+        def stream_chunks():
+            try:
+                for chunk in stream:
+                    if chunk.choices:
+                        yield chunk.choices[0].delta.content or ""
+            except Exception as e:
+                st.error(f"Error getting chat response: {str(e)}")
+
+        return stream_chunks()
     except Exception as e:
         st.error(f"Error getting chat response: {str(e)}")
         return None
@@ -187,24 +501,42 @@ def main():
     st.title("Shopping Iguatemi - Smart Contracts Assistant")
     
     # Initialize or get the collection and metadata
-    if 'collection' not in st.session_state or 'metadata' not in st.session_state:
-        collection, metadata = load_documents("contratos_json")
+    contract_mtimes = current_contract_mtimes("contratos_json")
+    if 'collection' not in st.session_state:
+        collection, metadata, search_index = load_documents("contratos_json")
         if collection and metadata:
             st.session_state.collection = collection
             st.session_state.metadata = metadata
+            st.session_state.aggregates = build_aggregates(metadata)
+            st.session_state.search_index = search_index
+            st.session_state.contract_mtimes = contract_mtimes
+    elif st.session_state.get('contract_mtimes') != contract_mtimes:
+        # Contract files changed under a live session; reuse the Parquet
+        # sidecar when another load already rewrote it, else stream just
+        # the metadata fields back out of the JSONs
+        metadata = load_metadata_sidecar("contratos_json")
+        if metadata is None:
+            metadata = refresh_metadata("contratos_json")
+            save_metadata_sidecar(metadata)
+        st.session_state.metadata = metadata
+        st.session_state.aggregates = build_aggregates(metadata)
+        st.session_state.contract_mtimes = contract_mtimes
     
-    query = st.text_input("Pergunte o que quiser sobre os contratos:")
-    
-    if query and st.session_state.get('collection'):
-        # Determine query type
-        is_global_query = any(keyword in query.lower() for keyword in 
-                            ['todos', 'todas', 'quantos', 'quantas', 'total', 
-                             'geral', 'shopping', 'contratos'])
-        
-        if is_global_query:
+    # A form batches keystrokes into one rerun, so retrieval and the LLM
+    # call only fire on submit instead of per character typed
+    with st.form("query_form"):
+        query = st.text_input("Pergunte o que quiser sobre os contratos:")
+        submitted = st.form_submit_button("Perguntar")
+
+    if submitted and query and st.session_state.get('collection'):
+        # Determine query type from one tokenization of the query
+        intents = detect_intents(query)
+
+        if "global_" in intents:
             results, metadata_summary = handle_global_query(
-                query, 
-                st.session_state.metadata,
+                query,
+                intents,
+                st.session_state.aggregates,
                 st.session_state.collection
             )
             
@@ -212,14 +544,16 @@ def main():
                 response = get_chat_response(query, "", metadata_summary)
             else:
                 context = "\n\n".join(results['documents'][0]) if results else ""
+                context = context[:GLOBAL_CONTEXT_CHAR_BUDGET]
                 response = get_chat_response(query, context)
         else:
-            results, _ = handle_store_query(query, st.session_state.collection)
+            results, _ = handle_store_query(query, st.session_state.search_index)
             context = results['documents'][0][0] if results else ""
             response = get_chat_response(query, context)
         
         if response:
-            st.write("Resposta:", response)
+            st.write("Resposta:")
+            st.write_stream(response)
             
             # Display source information
             with st.expander("Veja as referências"):